@@ -3,11 +3,18 @@
 from __future__ import annotations
 
 import argparse
+import codecs
+import functools
+import io
+import mmap
+import re
 import sys
 import unicodedata
 from collections import Counter
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import Iterable, Tuple
+from typing import AbstractSet, Iterable, Mapping, Tuple
 
 # --- Unicode range helpers ----------------------------------------------------
 # Covers the main Han ranges used in modern and historical texts.
@@ -26,31 +33,99 @@ HAN_RANGES: Tuple[Tuple[int, int], ...] = (
     (0x323B0, 0x33479), # Extension J
 )
 
+
+def _build_han_table(
+    ranges: Iterable[Tuple[int, int]],
+) -> Tuple[bytes, bytes]:
+    """Compile Han ranges into a two-level bitset.
+
+    The top level maps ``cp >> 8`` to a block number; each block is a 32-byte
+    bitset for the low 8 bits of the codepoint. Identical blocks (notably the
+    all-zero and all-one ones) are stored only once.
+    """
+    ranges = tuple(ranges)
+    top = max(end for _, end in ranges) >> 8
+    flat = bytearray((top + 1) * 32)
+    for start, end in ranges:
+        # Whole bytes by slice assignment; only the ragged edges bit by bit.
+        lo, hi = (start + 7) >> 3, (end + 1) >> 3
+        if lo < hi:
+            flat[lo:hi] = b"\xff" * (hi - lo)
+            edges = (range(start, lo << 3), range(hi << 3, end + 1))
+        else:
+            edges = (range(start, end + 1),)
+        for edge in edges:
+            for cp in edge:
+                flat[cp >> 3] |= 1 << (cp & 7)
+
+    blocks: dict[bytes, int] = {bytes(32): 0}
+    index = bytearray(top + 1)
+    for hi in range(top + 1):
+        block = bytes(flat[hi * 32:(hi + 1) * 32])
+        n = blocks.setdefault(block, len(blocks))
+        # Block numbers are stored in a bytearray, so there can be at most 256.
+        assert n < 256, "too many distinct Han bitset blocks"
+        index[hi] = n
+    return bytes(index), b"".join(blocks)
+
+
+_HAN_INDEX, _HAN_BLOCKS = _build_han_table(HAN_RANGES)
+
+# Enclosing bounds of all Han ranges, plus the BMP gap between the unified
+# and compatibility ideographs; anything here is rejected without a lookup.
+_HAN_MIN = min(start for start, _ in HAN_RANGES)
+_HAN_MAX = max(end for _, end in HAN_RANGES)
+_BMP_GAP = (0x9FFF, 0xF900)
+
+
 def is_han(ch: str) -> bool:
     if not ch:
         return False
     cp = ord(ch)
-    for start, end in HAN_RANGES:
-        if start <= cp <= end:
-            return True
-    return False
+    if cp < _HAN_MIN or cp > _HAN_MAX:
+        return False
+    if _BMP_GAP[0] < cp < _BMP_GAP[1]:
+        return False
+    byte = _HAN_BLOCKS[(_HAN_INDEX[cp >> 8] << 5) | ((cp & 0xFF) >> 3)]
+    return bool((byte >> (cp & 7)) & 1)
+
+# Whole-text counterpart of is_han: one C-level scan instead of a Python call
+# per character. Matching whole runs keeps the number of match objects low.
+_HAN_RUN_RE = re.compile(
+    "[" + "".join(f"\\U{start:08X}-\\U{end:08X}" for start, end in HAN_RANGES) + "]+"
+)
 
 # --- Core logic ----------------------------------------------------------------
 
-def load_inventory(path: Path) -> set[str]:
+# Inventories larger than this are memory-mapped and decoded slab by slab so
+# the whole file never has to exist as one Python str.
+_MMAP_THRESHOLD = 1 << 20
+_MMAP_SLAB = 1 << 20
+
+
+def load_inventory(path: Path) -> frozenset[str]:
     """Load inventory file and return a set of characters.
 
     The file can be a single long line of characters or multiple lines.
-    Whitespace is ignored.
+    Whitespace is ignored, and characters are NFC-normalised like the text.
     """
-    data = path.read_text(encoding="utf-8")
-    inv_chars = {ch for ch in data if is_han(ch)}
-    return inv_chars
+    if path.stat().st_size <= _MMAP_THRESHOLD:
+        data = path.read_text(encoding="utf-8")
+        return frozenset(_filter_text(data, han_only=True))
+
+    inv_chars: set[str] = set()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start in range(0, len(mm), _MMAP_SLAB):
+            chunk = decoder.decode(mm[start:start + _MMAP_SLAB])
+            inv_chars.update(_filter_text(chunk, han_only=True))
+        inv_chars.update(_filter_text(decoder.decode(b"", final=True), han_only=True))
+    return frozenset(inv_chars)
 
 
-def load_inventories(paths: Iterable[Path]) -> dict[str, set[str]]:
+def load_inventories(paths: Iterable[Path]) -> dict[str, frozenset[str]]:
     """Load multiple inventory files, keyed by filename stem."""
-    inventories: dict[str, set[str]] = {}
+    inventories: dict[str, frozenset[str]] = {}
     for p in paths:
         label = p.stem or str(p)
         base = label
@@ -62,29 +137,49 @@ def load_inventories(paths: Iterable[Path]) -> dict[str, set[str]]:
     return inventories
 
 
+def _filter_text(text: str, han_only: bool = True) -> str:
+    """Return ``text`` reduced to the characters ``iter_text_chars`` yields.
+
+    Text is NFC-normalised first so that canonically equivalent forms (e.g.
+    CJK Compatibility Ideographs) count as the same character everywhere.
+    """
+    text = unicodedata.normalize("NFC", text)
+    if han_only:
+        return "".join(_HAN_RUN_RE.findall(text))
+    return "".join(text.split())
+
+
 def iter_text_chars(text: str, han_only: bool = True) -> Iterable[str]:
-    for ch in text:
-        if han_only and not is_han(ch):
-            continue
-        if ch.strip() == "":  # skip whitespace
-            continue
-        yield ch
+    # Non-Han and whitespace characters are stripped in C by _filter_text.
+    yield from _filter_text(text, han_only=han_only)
 
 
-def coverage_report(
-    text: str,
-    inventory: set[str],
-    han_only: bool = True,
-) -> dict:
-    """Return a dict with coverage metrics and frequency tables."""
-    chars = list(iter_text_chars(text, han_only=han_only))
-    total = len(chars)
+def text_freq(text: str, han_only: bool = True) -> Counter[str]:
+    """Count the characters of ``text`` that coverage is measured on."""
+    return Counter(_filter_text(text, han_only=han_only))
+
+
+def _nfc_view(inventory: AbstractSet[str]) -> AbstractSet[str]:
+    """Return ``inventory`` normalised the same way ``_filter_text`` does text."""
+    return {unicodedata.normalize("NFC", ch) for ch in inventory}
+
 
-    known = [ch for ch in chars if ch in inventory]
-    unknown = [ch for ch in chars if ch not in inventory]
+def coverage_from_freq(freq: Counter[str], inventory: AbstractSet[str]) -> dict:
+    """Like ``coverage_report``, but from a precomputed ``text_freq`` table.
 
-    known_count = len(known)
-    unknown_count = len(unknown)
+    Lets several inventories be checked against one scan of the text.
+    """
+    inventory = _nfc_view(inventory)
+    # Classify unique characters only; insertion order (first occurrence) is
+    # kept so that most_common ties stay stable.
+    known_freq: Counter[str] = Counter()
+    unknown_freq: Counter[str] = Counter()
+    for ch, n in freq.items():
+        (known_freq if ch in inventory else unknown_freq)[ch] = n
+
+    known_count = sum(known_freq.values())
+    unknown_count = sum(unknown_freq.values())
+    total = known_count + unknown_count
     coverage = (known_count / total * 100.0) if total else 100.0
 
     return {
@@ -92,14 +187,30 @@ def coverage_report(
         "known_chars": known_count,
         "unknown_chars": unknown_count,
         "coverage_pct": coverage,
-        "known_freq": Counter(known),
-        "unknown_freq": Counter(unknown),
+        "known_freq": known_freq,
+        "unknown_freq": unknown_freq,
     }
 
 
+def coverage_report(
+    text: str,
+    inventory: AbstractSet[str],
+    han_only: bool = True,
+) -> dict:
+    r"""Return a dict with coverage metrics and frequency tables.
+
+    Text and inventory are both NFC-normalised, so they still match each
+    other when written with compatibility ideographs:
+
+    >>> coverage_report("\uF900\uF900", {"\uF900"})["coverage_pct"]
+    100.0
+    """
+    return coverage_from_freq(text_freq(text, han_only=han_only), inventory)
+
+
 def per_line_breakdown(
     text: str,
-    inventory: set[str],
+    inventory: AbstractSet[str],
     han_only: bool = True,
 ) -> list[tuple[int, int, int, float, str]]:
     """
@@ -107,16 +218,32 @@ def per_line_breakdown(
         (line_no, total, known, coverage_pct, line_text)
     Only Han characters (or all characters if han_only=False) are counted.
     """
+    text_lines = text.splitlines()
+    # Filter lazily: a one-off breakdown has no use for the cached list.
+    line_chars = (_filter_text(line, han_only=han_only) for line in text_lines)
+    return _line_breakdown(text_lines, line_chars, inventory)
+
+
+def _split_line_chars(text_lines: list[str], han_only: bool = True) -> list[str]:
+    """Filter each line once, for reuse by whole-text and per-line counts."""
+    return [_filter_text(line, han_only=han_only) for line in text_lines]
+
+
+def _line_breakdown(
+    text_lines: Iterable[str],
+    line_chars: Iterable[str],
+    inventory: AbstractSet[str],
+) -> list[tuple[int, int, int, float, str]]:
+    inventory = _nfc_view(inventory)
     results = []
-    for i, line in enumerate(text.splitlines(), start=1):
-        chars = list(iter_text_chars(line, han_only=han_only))
+    for i, (line, chars) in enumerate(zip(text_lines, line_chars), start=1):
         total = len(chars)
         if total == 0:
-            results.append((i, 0, 0, 100.0, line.rstrip("\n")))
+            results.append((i, 0, 0, 100.0, line))
             continue
-        known = sum(1 for ch in chars if ch in inventory)
+        known = sum(map(inventory.__contains__, chars))
         pct = known / total * 100.0
-        results.append((i, total, known, pct, line.rstrip("\n")))
+        results.append((i, total, known, pct, line))
     return results
 
 
@@ -126,6 +253,12 @@ def human_int(n: int) -> str:
     return f"{n:,}"
 
 
+@functools.lru_cache(maxsize=65536)
+def char_name(ch: str) -> str:
+    # Cached: the same OOV character is named in several report sections.
+    return unicodedata.name(ch, "<unnamed>")
+
+
 def print_stats_block(title: str, rep: dict) -> None:
     print(f"\n=== {title} ===")
     print(f"Total counted chars: {human_int(rep['total_chars'])}")
@@ -138,11 +271,11 @@ def print_oov_list(rep: dict) -> None:
     if rep["unknown_chars"] == 0:
         print("\nNo unknown characters. 🎉")
         return
-    unique_oov = list(rep["unknown_freq"].keys())
-    # Order by frequency desc then by codepoint for stability
-    unique_oov.sort(key=lambda ch: (-rep["unknown_freq"][ch], ord(ch)))
+    # Order by frequency desc then by codepoint for stability; single-char
+    # strings compare by codepoint, so no ord() key is needed.
+    ranked = sorted((-cnt, ch) for ch, cnt in rep["unknown_freq"].items())
     print("\nList of characters not present (unique OOV, freq-desc):")
-    print("".join(unique_oov))
+    print("".join(ch for _, ch in ranked))
 
 
 def print_oov_frequency(rep: dict, top_n: int) -> None:
@@ -152,42 +285,75 @@ def print_oov_frequency(rep: dict, top_n: int) -> None:
     print(f"\nTop {top_n} unknown characters (high frequency):")
     for ch, cnt in rep["unknown_freq"].most_common(top_n):
         code = f"U+{ord(ch):04X}"
-        try:
-            name = unicodedata.name(ch)
-        except ValueError:
-            name = "<unnamed>"
+        name = char_name(ch)
         print(f"{ch}\t{cnt}\t{code}\t{name}")
 
     # Low-frequency (bottom N)
-    items = list(rep["unknown_freq"].items())
-    items.sort(key=lambda kv: (kv[1], ord(kv[0])))
-    bottom = items[:top_n]
+    bottom = sorted((cnt, ch) for ch, cnt in rep["unknown_freq"].items())[:top_n]
     print(f"\nBottom {top_n} unknown characters (low frequency):")
-    for ch, cnt in bottom:
+    for cnt, ch in bottom:
         code = f"U+{ord(ch):04X}"
-        try:
-            name = unicodedata.name(ch)
-        except ValueError:
-            name = "<unnamed>"
+        name = char_name(ch)
         print(f"{ch}\t{cnt}\t{code}\t{name}")
 
 
+def _format_oov(rep: dict, top_n: int, empty_msg: str) -> list[str]:
+    """Return the OOV list plus top-/bottom-N frequency lines for a report."""
+    if not rep["unknown_chars"]:
+        return [f"\n{empty_msg}"]
+    freq = rep["unknown_freq"]
+
+    # A single sort by (freq, codepoint) gives the bottom-N directly. The
+    # freq-desc OOV list wants the same codepoint order within each frequency,
+    # so it is just those groups in reverse. Single-char strings already
+    # compare by codepoint, so plain (cnt, ch) tuples need no key function.
+    ranked = sorted((cnt, ch) for ch, cnt in freq.items())
+    groups = [
+        "".join(ch for _, ch in grp) for _, grp in groupby(ranked, key=itemgetter(0))
+    ]
+    unique_oov = "".join(reversed(groups))
+
+    lines = ["\nList of characters not present (unique OOV, freq-desc):", unique_oov]
+    lines.append(f"\nTop {top_n} unknown characters (high frequency):")
+    for ch, cnt in freq.most_common(top_n):
+        lines.append(f"{ch}\t{cnt}\tU+{ord(ch):04X}\t{char_name(ch)}")
+    lines.append(f"\nBottom {top_n} unknown characters (low frequency):")
+    for cnt, ch in ranked[:top_n]:
+        lines.append(f"{ch}\t{cnt}\tU+{ord(ch):04X}\t{char_name(ch)}")
+    return lines
+
+
 # --- Programmatic API (import-friendly) --------------------------------------
 
 def build_report_text(
     text: str,
-    inventories: dict[str, set[str]],
+    inventories: Mapping[str, AbstractSet[str]],
     *,
     union: bool = False,
     top_unknown: int = 15,
     han_only: bool = True,
     per_line: bool = False,
 ) -> str:
-    lines: list[str] = []
-
-    # Compute reports
+    # Written straight into one buffer: with --per-line the report can run to
+    # millions of lines, and a list of them would sit alongside the result.
+    out = io.StringIO()
+
+    def emit(line: str) -> None:
+        if out.tell():
+            out.write("\n")
+        out.write(line)
+
+    # Scan the text once; every inventory is checked against the same table.
+    # Line separators are whitespace, so the per-line filtered chars joined
+    # together count exactly what a whole-text scan would.
+    if per_line:
+        text_lines = text.splitlines()
+        line_chars = _split_line_chars(text_lines, han_only=han_only)
+        freq = Counter("".join(line_chars))
+    else:
+        freq = text_freq(text, han_only=han_only)
     reports: dict[str, dict] = {
-        label: coverage_report(text, inv, han_only=han_only)
+        label: coverage_from_freq(freq, inv)
         for label, inv in inventories.items()
     }
 
@@ -195,100 +361,53 @@ def build_report_text(
     union_set = None
     if union and len(inventories) > 1:
         union_set = set().union(*inventories.values())
-        union_report = coverage_report(text, union_set, han_only=han_only)
+        # A character is known under the union iff some inventory knows it,
+        # so only the per-report known keys need merging, not the full sets.
+        union_known = set().union(*(rep["known_freq"].keys() for rep in reports.values()))
+        union_report = coverage_from_freq(freq, union_known)
 
     # Header
-    lines.append("=== Inventories Loaded ===")
-    for label, inv in inventories.items():
-        lines.append(f"- {label}: {human_int(len(inv))} characters")
+    inv_sizes = {label: len(inv) for label, inv in inventories.items()}
+    emit("=== Inventories Loaded ===")
+    for label, size in inv_sizes.items():
+        emit(f"- {label}: {human_int(size)} characters")
     if union_report is not None:
-        lines.append(
-            f"- <union>: {human_int(sum(len(inv) for inv in inventories.values()))} "
+        raw_sum = sum(inv_sizes.values())
+        emit(
+            f"- <union>: {human_int(raw_sum)} "
             f"(raw sum; union unique size {human_int(len(union_set))})"
         )
 
     # Per-inventory results
     for label, rep in reports.items():
-        lines.append(f"\n=== Results for [{label}] ===")
-        lines.append(f"Total counted chars: {human_int(rep['total_chars'])}")
-        lines.append(f"Known (in-inventory): {human_int(rep['known_chars'])}")
-        lines.append(f"Unknown (OOV): {human_int(rep['unknown_chars'])}")
-        lines.append(f"Coverage: {rep['coverage_pct']:.2f}%")
-
-        if rep["unknown_chars"]:
-            unique_oov = list(rep["unknown_freq"].keys())
-            unique_oov.sort(key=lambda ch: (-rep["unknown_freq"][ch], ord(ch)))
-            lines.append("\nList of characters not present (unique OOV, freq-desc):")
-            lines.append("".join(unique_oov))
-
-            # High-frequency
-            lines.append(f"\nTop {top_unknown} unknown characters (high frequency):")
-            for ch, cnt in rep["unknown_freq"].most_common(top_unknown):
-                code = f"U+{ord(ch):04X}"
-                try:
-                    name = unicodedata.name(ch)
-                except ValueError:
-                    name = "<unnamed>"
-                lines.append(f"{ch}\t{cnt}\t{code}\t{name}")
-
-            # Low-frequency
-            items = sorted(rep["unknown_freq"].items(), key=lambda kv: (kv[1], ord(kv[0])))
-            bottom = items[:top_unknown]
-            lines.append(f"\nBottom {top_unknown} unknown characters (low frequency):")
-            for ch, cnt in bottom:
-                code = f"U+{ord(ch):04X}"
-                try:
-                    name = unicodedata.name(ch)
-                except ValueError:
-                    name = "<unnamed>"
-                lines.append(f"{ch}\t{cnt}\t{code}\t{name}")
-        else:
-            lines.append("\nNo unknown characters. 🎉")
+        emit(f"\n=== Results for [{label}] ===")
+        emit(f"Total counted chars: {human_int(rep['total_chars'])}")
+        emit(f"Known (in-inventory): {human_int(rep['known_chars'])}")
+        emit(f"Unknown (OOV): {human_int(rep['unknown_chars'])}")
+        emit(f"Coverage: {rep['coverage_pct']:.2f}%")
+
+        for line in _format_oov(rep, top_unknown, "No unknown characters. 🎉"):
+            emit(line)
 
         if per_line:
-            lines.append("\nPer-line coverage:")
-            for line_no, total, known, pct, line in per_line_breakdown(
-                text, inventories[label], han_only=han_only
+            emit("\nPer-line coverage:")
+            for line_no, total, known, pct, line in _line_breakdown(
+                text_lines, line_chars, inventories[label]
             ):
-                lines.append(f"{line_no:>4}: {known:>4}/{total:<4} {pct:6.2f}% | {line}")
+                emit(f"{line_no:>4}: {known:>4}/{total:<4} {pct:6.2f}% | {line}")
 
     # Union block
     if union_report is not None:
         rep = union_report
-        lines.append("\n=== Results for [UNION of inventories] ===")
-        lines.append(f"Total counted chars: {human_int(rep['total_chars'])}")
-        lines.append(f"Known (in-inventory): {human_int(rep['known_chars'])}")
-        lines.append(f"Unknown (OOV): {human_int(rep['unknown_chars'])}")
-        lines.append(f"Coverage: {rep['coverage_pct']:.2f}%")
-        if rep["unknown_chars"]:
-            unique_oov = list(rep["unknown_freq"].keys())
-            unique_oov.sort(key=lambda ch: (-rep["unknown_freq"][ch], ord(ch)))
-            lines.append("\nList of characters not present (unique OOV, freq-desc):")
-            lines.append("".join(unique_oov))
-
-            lines.append(f"\nTop {top_unknown} unknown characters (high frequency):")
-            for ch, cnt in rep["unknown_freq"].most_common(top_unknown):
-                code = f"U+{ord(ch):04X}"
-                try:
-                    name = unicodedata.name(ch)
-                except ValueError:
-                    name = "<unnamed>"
-                lines.append(f"{ch}\t{cnt}\t{code}\t{name}")
-
-            items = sorted(rep["unknown_freq"].items(), key=lambda kv: (kv[1], ord(kv[0])))
-            bottom = items[:top_unknown]
-            lines.append(f"\nBottom {top_unknown} unknown characters (low frequency):")
-            for ch, cnt in bottom:
-                code = f"U+{ord(ch):04X}"
-                try:
-                    name = unicodedata.name(ch)
-                except ValueError:
-                    name = "<unnamed>"
-                lines.append(f"{ch}\t{cnt}\t{code}\t{name}")
-        else:
-            lines.append("\nNo unknown characters under union. 🎉")
+        emit("\n=== Results for [UNION of inventories] ===")
+        emit(f"Total counted chars: {human_int(rep['total_chars'])}")
+        emit(f"Known (in-inventory): {human_int(rep['known_chars'])}")
+        emit(f"Unknown (OOV): {human_int(rep['unknown_chars'])}")
+        emit(f"Coverage: {rep['coverage_pct']:.2f}%")
+        for line in _format_oov(rep, top_unknown, "No unknown characters under union. 🎉"):
+            emit(line)
 
-    return "\n".join(lines)
+    return out.getvalue()
 
 
 def run_analysis_from_files(
@@ -389,19 +508,7 @@ def main(argv: list[str] | None = None) -> int:
             p.error(f"Input file not found: {args.input}")
         text = args.input.read_text(encoding="utf-8")
 
-    # Compute reports
-    reports: dict[str, dict] = {}
-    for label, inv in inventories.items():
-        reports[label] = coverage_report(text, inv, han_only=not args.all_chars)
-
-    # Optionally union inventory
-    union_report = None
-    if args.union and len(inventories) > 1:
-        union_set = set().union(*inventories.values())
-        union_report = coverage_report(text, union_set, han_only=not args.all_chars)
-
-    
-# --- OUTPUT SECTION -------------------------------------------------------
+    # --- OUTPUT SECTION -------------------------------------------------------
     # Build one consolidated report text so it can be printed and/or saved.
     consolidated = build_report_text(
         text,